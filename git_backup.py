@@ -4,13 +4,13 @@ import os
 from os.path import isdir
 from subprocess import call
 import argparse
-import yaml
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import gitutils
 import shellutils
-import rich
-from jsonschema import validate
-from plumbum import local, FG
-from plumbum.cmd import bash
+
+# Third-party modules other than plumbum are imported inside the functions that use them, since
+# importing them at the top of the module noticeably slows down startup for short commands
 
 #
 # CONSTANTS
@@ -24,6 +24,8 @@ CONFIG_FILE_NAME = 'config.yaml'
 CONFIG_FILE_PATH = os.path.join(TRACKING_REPO_PATH, CONFIG_FILE_NAME)
 TRACKED_REPOS_DIR_NAME = 'tracked-repos'
 TRACKED_REPOS_DIR_PATH = os.path.join(TRACKING_REPO_PATH, TRACKED_REPOS_DIR_NAME)
+DEFAULT_JOBS = os.cpu_count() or 8
+DEFAULT_FETCH_JOBS = 8
 DEFAULT_CONFIG_FILE_CONTENTS = '''\
 # If set to true, GitHub will be included as a remote by calling out to the gh CLI tool
 # You will be prompted as to whether to add a given repo to GitHub, and to choose various properties, e.g. repo visibility
@@ -34,26 +36,22 @@ gh: False
 #  - example.com
 # Unlike the gh property, these remotes will be used for every repo you create
 ssh_remotes: []
+# Number of remotes to fetch from in parallel for each repo
+fetch_jobs: 8
 # Change this to TRUE when you are happy with your config
 config_is_ready: FALSE
 '''
 
-config_schema = yaml.safe_load('''
-type: object
-required:
- - gh
- - ssh_remotes
- - config_is_ready
-properties:
-  gh:
-    type: boolean
-  ssh_remotes:
-    type: array
-    items:
-      type: string
-  config_is_ready:
-    type: boolean
-''')
+CONFIG_SCHEMA = {
+    'type': 'object',
+    'required': ['gh', 'ssh_remotes', 'config_is_ready'],
+    'properties': {
+        'gh': {'type': 'boolean'},
+        'ssh_remotes': {'type': 'array', 'items': {'type': 'string'}},
+        'fetch_jobs': {'type': 'integer', 'minimum': 1},
+        'config_is_ready': {'type': 'boolean'},
+    },
+}
 
 #
 # HELPER METHODS
@@ -64,27 +62,46 @@ def parse_args():
     subparsers = parser.add_subparsers(dest="command", required=True)
     init_parser = subparsers.add_parser('init')
     init_parser.add_argument('--resume', action='store_true')
-    subparsers.add_parser('fetch')
-    subparsers.add_parser('status')
-    subparsers.add_parser('push')
-    subparsers.add_parser('update')
+    init_parser.set_defaults(func=command_init)
+    fetch_parser = subparsers.add_parser('fetch')
+    add_jobs_argument(fetch_parser)
+    fetch_parser.set_defaults(func=command_fetch)
+    status_parser = subparsers.add_parser('status')
+    add_jobs_argument(status_parser)
+    status_parser.set_defaults(func=command_status)
+    push_parser = subparsers.add_parser('push')
+    add_jobs_argument(push_parser)
+    push_parser.set_defaults(func=command_push)
+    update_parser = subparsers.add_parser('update')
+    update_parser.set_defaults(func=command_update)
     create_parser = subparsers.add_parser('create')
     create_parser.add_argument('repo')
+    create_parser.set_defaults(func=command_create)
     create_on_remote_parser = subparsers.add_parser('create-on-remote')
     create_on_remote_parser.add_argument('repo')
+    create_on_remote_parser.set_defaults(func=command_create_on_remote)
     reset_remotes_parser = subparsers.add_parser('reset-remotes')
     reset_remotes_parser.add_argument('repo')
+    reset_remotes_parser.set_defaults(func=command_reset_remotes)
     add_remotes_parser = subparsers.add_parser('add-remotes')
     add_remotes_parser.add_argument('repo')
+    add_remotes_parser.set_defaults(func=command_add_remotes)
     clone_url_parser = subparsers.add_parser('clone-url')
     clone_url_parser.add_argument('repo')
     clone_url_parser.add_argument('url')
+    clone_url_parser.set_defaults(func=command_clone_url)
     clone_gh_parser = subparsers.add_parser('clone-gh')
     clone_gh_parser.add_argument('repo')
+    clone_gh_parser.set_defaults(func=command_clone_gh)
     foreach_parser = subparsers.add_parser('foreach')
     foreach_parser.add_argument('cmd')
+    add_jobs_argument(foreach_parser)
+    foreach_parser.set_defaults(func=command_foreach)
     return parser.parse_args()
 
+def add_jobs_argument(parser):
+    parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS, help=f'number of repos to process in parallel (default: {DEFAULT_JOBS})')
+
 def verify_initialised_and_load_config():
     if not os.path.exists(CONFIG_FILE_PATH):
         sys.exit(f'Could not find config file at path "{CONFIG_FILE_PATH}".\n' +
@@ -94,48 +111,104 @@ def verify_initialised_and_load_config():
                  f'If initialisation was still in progress, you may need to run "git_backup init --resume".')
     return load_config()
 
+@functools.lru_cache(maxsize=None)
+def get_config_validator():
+    from jsonschema import Draft7Validator
+    return Draft7Validator(CONFIG_SCHEMA)
+
+# Maps a config file path to (st_mtime_ns, st_size, st_ino, config) as of when it was last loaded
+_CONFIG_CACHE = {}
+
 def load_config():
+    st = os.stat(CONFIG_FILE_PATH)
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _CONFIG_CACHE.get(CONFIG_FILE_PATH)
+    if cached and cached[:3] == key:
+        return cached[3]
+    import yaml
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
     loaded_yaml = None
     with open(CONFIG_FILE_PATH, 'r') as f:
         try:
-            loaded_yaml = yaml.safe_load(f)
+            loaded_yaml = yaml.load(f, Loader=SafeLoader)
         except yaml.YAMLError as ex:
             print(ex, file=sys.stderr)
             sys.exit(f'Failed to load config at path "{CONFIG_FILE_PATH}".')
-    validate(loaded_yaml, config_schema)
+    get_config_validator().validate(loaded_yaml)
+    _CONFIG_CACHE[CONFIG_FILE_PATH] = (*key, loaded_yaml)
     return loaded_yaml
 
-def check_and_get_repos():
-    tracked_repos = []
+def list_repos():
+    tracked_repos = set(shellutils.listdir_nohidden(TRACKED_REPOS_DIR_PATH))
+    # Keep the DirEntry for each name, which caches whether it is a directory
+    actual_repos = {entry.name: entry for entry in shellutils.scandir_nohidden(REPOS_DIR_PATH)}
+    return tracked_repos, actual_repos
+
+def check_and_get_repos(tracked_repos, actual_repos):
+    repos = []
     warnings = []
-    for repo_name in shellutils.listdir_nohidden(TRACKED_REPOS_DIR_PATH):
+    for repo_name in sorted(tracked_repos):
         path = os.path.join(REPOS_DIR_PATH, repo_name)
-        if not os.path.isdir(path):
+        entry = actual_repos.get(repo_name)
+        if entry is None or not entry.is_dir():
             warnings.append(f'Skipping "{repo_name}": repo is tracked but "{path}" does not exist.')
             continue
-        if not gitutils.is_git_repo(path):
+        if not gitutils.is_git_repo(entry.path):
             warnings.append(f'Skipping "{repo_name}": repo is tracked but "{path}" is not a git repo.')
             continue
-        tracked_repos.append(repo_name)
+        repos.append(repo_name)
     for warning in warnings:
         print(warning, file=sys.stderr)
-    return tracked_repos
-
-def show_tracked_repos_notice():
-    tracked_repos = set(shellutils.listdir_nohidden(TRACKED_REPOS_DIR_PATH))
-    actual_repos = set(shellutils.listdir_nohidden(REPOS_DIR_PATH))
+    return repos
+
+def show_tracked_repos_notice(tracked_repos, actual_repos):
+    import rich
+    import rich.markup
+    def format_repo_list(repo_names):
+        text = '\n'.join(f' - {repo_name}' for repo_name in sorted(repo_names))
+        # rich reads '[' as the start of a tag, and a trailing backslash would escape the closing tag
+        # appended after the list
+        return rich.markup.escape(text) if '[' in text or '\\' in text else text
     fmt_tag, fmt_tag_end = '[yellow]', '[/yellow]'
-    if tracked_repos - actual_repos:
+    missing_repos = tracked_repos - actual_repos.keys()
+    untracked_repos = actual_repos.keys() - tracked_repos
+    if missing_repos:
         rich.print(f'{fmt_tag}The following repos are tracked but do not exist in ~/repos:{fmt_tag_end}')
-        rich.print(fmt_tag + rich.markup.escape('\n'.join([f' - {repo_name}' for repo_name in tracked_repos - actual_repos])) + fmt_tag_end)
+        rich.print(fmt_tag + format_repo_list(missing_repos) + fmt_tag_end)
         rich.print(f'{fmt_tag}Consider cloning them with git_backup clone [repo_name]{fmt_tag_end}')
-    if actual_repos - tracked_repos:
+    if untracked_repos:
         rich.print(f'{fmt_tag}The following directories are in ~/repos but are not tracked:{fmt_tag_end}')
-        rich.print(fmt_tag + rich.markup.escape('\n'.join([f' - {repo_name}' for repo_name in actual_repos - tracked_repos])) + fmt_tag_end)
+        rich.print(fmt_tag + format_repo_list(untracked_repos) + fmt_tag_end)
         rich.print(f'{fmt_tag}Consider creating them on remotes with git_backup create [repo_name]{fmt_tag_end}')
 
-def print_repo_name_header(repo_name):
-    rich.print(f'[bold green] {repo_name} [/bold green]')
+def print_repo_name_header(repo_name, failed=False):
+    import rich
+    if failed:
+        rich.print(f'[bold red] {repo_name} (failed) [/bold red]')
+    else:
+        rich.print(f'[bold green] {repo_name} [/bold green]')
+
+def run_for_each_repo(tracked_repos, jobs, action):
+    # action is called with the path of each repo, possibly from several threads at once, and returns
+    # (retcode, output). Results are printed from this thread in the order of tracked_repos, so the
+    # output is the same from run to run. Returns the names of the repos for which action failed.
+    failed_repos = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(action, os.path.join(REPOS_DIR_PATH, repo_name)) for repo_name in tracked_repos]
+        for repo_name, future in zip(tracked_repos, futures):
+            retcode, output = future.result()
+            if retcode != 0:
+                failed_repos.append(repo_name)
+            print_repo_name_header(repo_name, failed=retcode != 0)
+            print(output)
+    return failed_repos
+
+def exit_if_any_failed(failed_repos):
+    if failed_repos:
+        sys.exit('The following repos failed:' + ''.join(f'\n - {repo_name}' for repo_name in sorted(failed_repos)))
 
 #
 # COMMANDS
@@ -143,7 +216,7 @@ def print_repo_name_header(repo_name):
 
 def command_init(args):
     def resume_init(config):
-        if gitutils.is_git_repo(TRACKING_REPO_PATH):
+        if gitutils.is_inside_git_work_tree(TRACKING_REPO_PATH):
             sys.exit(f'Tracking repository directory already belongs to a local git repository, which should not be the case during initialisation. Aborting.')
 
         prompt_result = gitutils.prompt_remote_repo_creation(TRACKING_REPO_NAME, config)
@@ -189,35 +262,33 @@ def command_init(args):
 
 def command_update(args):
     config = verify_initialised_and_load_config()
-    gitutils.tracking_repo_git_pull()
-    show_tracked_repos_notice()
+    gitutils.tracking_repo_git_pull(config.get('fetch_jobs', DEFAULT_FETCH_JOBS))
+    show_tracked_repos_notice(*list_repos())
 
 def command_status(args):
     config = verify_initialised_and_load_config()
-    tracked_repos = check_and_get_repos()
-    for repo_name in tracked_repos:
-        print_repo_name_header(repo_name)
-        gitutils.git_status(os.path.join(REPOS_DIR_PATH, repo_name))
-        print()
-    show_tracked_repos_notice()
+    tracked_repos, actual_repos = list_repos()
+    repos = check_and_get_repos(tracked_repos, actual_repos)
+    failed_repos = run_for_each_repo(repos, args.jobs, gitutils.git_status)
+    show_tracked_repos_notice(tracked_repos, actual_repos)
+    exit_if_any_failed(failed_repos)
 
 def command_fetch(args):
     config = verify_initialised_and_load_config()
-    tracked_repos = check_and_get_repos()
-    for repo_name in tracked_repos:
-        print_repo_name_header(repo_name)
-        gitutils.git_fetch_all(os.path.join(REPOS_DIR_PATH, repo_name))
-        print()
-    show_tracked_repos_notice()
+    tracked_repos, actual_repos = list_repos()
+    repos = check_and_get_repos(tracked_repos, actual_repos)
+    fetch_jobs = config.get('fetch_jobs', DEFAULT_FETCH_JOBS)
+    failed_repos = run_for_each_repo(repos, args.jobs, lambda path: gitutils.git_fetch_all(path, fetch_jobs))
+    show_tracked_repos_notice(tracked_repos, actual_repos)
+    exit_if_any_failed(failed_repos)
 
 def command_push(args):
     config = verify_initialised_and_load_config()
-    tracked_repos = check_and_get_repos()
-    for repo_name in tracked_repos:
-        print_repo_name_header(repo_name)
-        gitutils.git_push_all_all_remotes(os.path.join(REPOS_DIR_PATH, repo_name))
-        print()
-    show_tracked_repos_notice()
+    tracked_repos, actual_repos = list_repos()
+    repos = check_and_get_repos(tracked_repos, actual_repos)
+    failed_repos = run_for_each_repo(repos, args.jobs, gitutils.git_push_all_all_remotes)
+    show_tracked_repos_notice(tracked_repos, actual_repos)
+    exit_if_any_failed(failed_repos)
 
 def command_create(args):
     repo_name = args.repo
@@ -309,47 +380,34 @@ def command_clone_gh(args):
 def command_foreach(args):
     cmd = args.cmd
     config = verify_initialised_and_load_config()
-    tracked_repos = check_and_get_repos()
-    for repo_name in tracked_repos:
-        print_repo_name_header(repo_name)
-        with local.cwd(os.path.join(REPOS_DIR_PATH, repo_name)):
-            bash['-c', cmd] & FG
-        print()
-    show_tracked_repos_notice()
+    tracked_repos, actual_repos = list_repos()
+    repos = check_and_get_repos(tracked_repos, actual_repos)
+    from plumbum import local, RETCODE
+    from plumbum.cmd import bash
+    if args.jobs == 1:
+        # Run in the foreground so that interactive commands (pagers, editors, git add -p) still work
+        failed_repos = []
+        for repo_name in repos:
+            print_repo_name_header(repo_name)
+            with local.cwd(os.path.join(REPOS_DIR_PATH, repo_name)):
+                if bash['-c', cmd] & RETCODE(FG=True) != 0:
+                    failed_repos.append(repo_name)
+            print()
+    else:
+        failed_repos = run_for_each_repo(repos, args.jobs, lambda path: shellutils.run_combined(bash['-c', cmd], cwd=path))
+    show_tracked_repos_notice(tracked_repos, actual_repos)
+    exit_if_any_failed(failed_repos)
 
 #
 # MAIN
 #
 
 def main():
+    # Stop gh from checking for a newer release on every call
+    os.environ.setdefault('GH_NO_UPDATE_NOTIFIER', '1')
     args = parse_args()
 
-    if args.command == 'init':
-        command_init(args)
-    elif args.command == 'fetch':
-        command_fetch(args)
-    elif args.command == 'status':
-        command_status(args)
-    elif args.command == 'push':
-        command_push(args)
-    elif args.command == 'update':
-        command_update(args)
-    elif args.command == 'create':
-        command_create(args)
-    elif args.command == 'create-on-remote':
-        command_create_on_remote(args)
-    elif args.command == 'reset-remotes':
-        command_reset_remotes(args)
-    elif args.command == 'add-remotes':
-        command_add_remotes(args)
-    elif args.command == 'clone-url':
-        command_clone_url(args)
-    elif args.command == 'clone-gh':
-        command_clone_gh(args)
-    elif args.command == 'foreach':
-        command_foreach(args)
-    else:
-        sys.exit(f'Unknown command "{args.command}".')
+    args.func(args)
 
 if __name__ == '__main__':
     main()
@@ -1,80 +1,211 @@
 
 import sys
 import os
+import io
+import functools
+import atexit
+import shlex
+from concurrent.futures import ThreadPoolExecutor
 
 from git_backup import REPOS_DIR_NAME, REPOS_DIR_PATH, TRACKING_REPO_PATH
 import plumbum
 import shellutils
 from plumbum import FG, BG, RETCODE
 from plumbum import local
-from plumbum.cmd import git, gh, pwd, xargs
 from plumbum import SshMachine
 
 GITHUB_REMOTE_NAME = 'github'
 
+# Commands are looked up on the PATH the first time they are used rather than at import time
+
+@functools.lru_cache(maxsize=None)
+def _git():
+    return local['git']
+
+@functools.lru_cache(maxsize=None)
+def _gh():
+    return local['gh']
+
+# SSH connections are kept open per host until exit, and multiplexed with ControlMaster so that git
+# commands given SSH_OPTS (see git_ssh_env) can reuse them instead of connecting again
+SSH_CONTROL_DIR = os.path.join(os.path.expanduser('~'), '.ssh', 'git-backup')
+SSH_OPTS = ['-o', 'ControlMaster=auto', '-o', 'ControlPersist=60s', '-o', f'ControlPath={SSH_CONTROL_DIR}/%C']
+_SSH_MACHINES = {}
+
+def get_ssh_machine(hostname):
+    if hostname not in _SSH_MACHINES:
+        os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+        _SSH_MACHINES[hostname] = SshMachine(hostname, ssh_opts=SSH_OPTS)
+    return _SSH_MACHINES[hostname]
+
+def _close_ssh_machines():
+    for remote in _SSH_MACHINES.values():
+        remote.close()
+    _SSH_MACHINES.clear()
+
+atexit.register(_close_ssh_machines)
+
 def is_git_repo(path):
-    with local.cwd(path):
-        retcode, stdout, stderr = git['rev-parse', '--is-inside-work-tree'].run(retcode = None)
-        return stdout == 'true\n'
+    # .git is a file rather than a directory for worktrees and submodules
+    dot_git = os.path.join(path, '.git')
+    return os.path.isdir(dot_git) or os.path.isfile(dot_git)
+
+def is_inside_git_work_tree(path):
+    # Slower than is_git_repo, but also true when path is nested inside another repo's work tree
+    retcode, stdout, stderr = _git()['-C', path, 'rev-parse', '--is-inside-work-tree'].run(retcode = None)
+    return stdout == 'true\n'
 
 def git_init(path):
-    if is_git_repo(path):
+    if is_inside_git_work_tree(path):
         raise RuntimeError(f'Cannot initialise local git repo at {path} since it already is or belongs to a local git repository.')
-    with local.cwd(path):
-        git('init', '.')
+    _git()('-C', path, 'init', '.')
 
 def git_add(path):
-    with local.cwd(path):
-        git('add', '.')
+    _git()('-C', path, 'add', '.')
 
 def git_commit(path, message):
-    with local.cwd(path):
-        git('commit', '-m', message)
-
-def git_fetch_all(path):
-    with local.cwd(path):
-        git['fetch', '--all'] & FG
+    _git()('-C', path, 'commit', '-m', message)
+
+# Give up on remotes that stop responding rather than letting one of them stall a whole fetch
+# Maps each environment variable to the git config setting it overrides, and the value to use for it
+FETCH_HTTP_OPTIONS = {
+    'GIT_HTTP_LOW_SPEED_LIMIT': ('lowspeedlimit', '1000'),
+    'GIT_HTTP_LOW_SPEED_TIME': ('lowspeedtime', '10'),
+}
+FETCH_SSH_OPTIONS = {
+    'ConnectTimeout': '5',
+    'ServerAliveInterval': '5',
+}
+
+# Best-effort only: this reads ~/.ssh/config alone, without following Include or reading
+# /etc/ssh/ssh_config, and counts a keyword set under any Host block as set for every host. So an
+# option may still be added that the user sets elsewhere, or left out for hosts that do not set it.
+@functools.lru_cache(maxsize=None)
+def _ssh_config_keywords():
+    keywords = set()
+    try:
+        with open(os.path.expanduser('~/.ssh/config'), 'r') as f:
+            for line in f:
+                words = line.replace('=', ' ').split()
+                if words and not words[0].startswith('#'):
+                    keywords.add(words[0].lower())
+    except OSError:
+        pass
+    return frozenset(keywords)
+
+def git_ssh_env(path, ssh_opts):
+    # GIT_SSH_COMMAND takes priority over GIT_SSH and core.sshCommand, so only set it when the user has
+    # not chosen their own ssh command in any of those places
+    if not ssh_opts or 'GIT_SSH_COMMAND' in os.environ or 'GIT_SSH' in os.environ:
+        return {}
+    retcode, stdout, stderr = _git()['-C', path, 'config', 'core.sshCommand'].run(retcode = None)
+    if retcode == 0:
+        return {}
+    return {'GIT_SSH_COMMAND': shlex.join(['ssh', *ssh_opts])}
+
+def fetch_http_env(path):
+    # These variables win over http.lowSpeedLimit/lowSpeedTime, so leave out any the user already sets
+    # in the environment or in git config (including per-URL http.<url>.* settings)
+    retcode, stdout, stderr = _git()['-C', path, 'config', '--get-regexp', r'^http\..*lowspeed(limit|time)$'].run(retcode = None)
+    configured = {line.split(' ', 1)[0].rsplit('.', 1)[-1] for line in stdout.splitlines()}
+    env = {}
+    for name, (config_name, value) in FETCH_HTTP_OPTIONS.items():
+        if name not in os.environ and config_name not in configured:
+            env[name] = value
+    return env
+
+def fetch_ssh_opts():
+    # Options given on the command line override ssh config, so leave out any the user appears to set
+    # there (see _ssh_config_keywords for the limits of that check)
+    ssh_opts = []
+    for name, value in FETCH_SSH_OPTIONS.items():
+        if name.lower() not in _ssh_config_keywords():
+            ssh_opts += ['-o', f'{name}={value}']
+    return ssh_opts
+
+# The following helpers may run concurrently for different repos, so they pass the repo path to git
+# with -C rather than changing local.cwd (which is shared by every thread), and return their return
+# code and output instead of writing to the terminal.
+
+def git_fetch_all(path, jobs):
+    return shellutils.run_combined(_git()['-C', path, 'fetch', '--all', '--prune', f'--jobs={jobs}'].with_env(**fetch_http_env(path), **git_ssh_env(path, fetch_ssh_opts())))
 
 def git_status(path):
-    with local.cwd(path):
-        git['status'] & FG
-
+    # Only show the full status for repos that have changes, are ahead of/behind their upstream, have
+    # an upstream that no longer exists, or have a detached HEAD
+    retcode, stdout, stderr = _git()['-C', path, 'status', '--porcelain=v2', '--branch'].run(retcode = None)
+    if retcode == 0:
+        branch = None
+        upstream = None
+        ahead_behind = None
+        dirty = False
+        for line in stdout.splitlines():
+            if line.startswith('# branch.head '):
+                branch = line[len('# branch.head '):]
+            elif line.startswith('# branch.upstream '):
+                upstream = line[len('# branch.upstream '):]
+            elif line.startswith('# branch.ab '):
+                ahead_behind = line[len('# branch.ab '):]
+            elif not line.startswith('#'):
+                dirty = True
+        # branch.upstream without branch.ab means the upstream branch is gone
+        upstream_ok = ahead_behind == '+0 -0' or (upstream is None and ahead_behind is None)
+        if not dirty and upstream_ok and branch != '(detached)':
+            upstream_state = 'no upstream' if upstream is None else f'up to date with {upstream}'
+            return 0, f'On branch {branch}: clean, {upstream_state}\n'
+    return shellutils.run_combined(_git()['-C', path, 'status'])
+
+# Cached since several helpers need the remotes of the same repo; call git_list_remotes.cache_clear()
+# after adding or removing a remote
+@functools.lru_cache(maxsize=32)
 def git_list_remotes(path):
-    with local.cwd(path):
-        return git('remote').split('\n')[:-1]
+    return frozenset(_git()('-C', path, 'remote').split('\n')[:-1])
+
+def git_push_all(path, remote):
+    return shellutils.run_combined(_git()['-C', path, 'push', '--all', remote])
 
 def git_push_all_all_remotes(path):
-    with local.cwd(path):
-        for remote in git_list_remotes(path):
-            print(remote)
-            git['push', '--all', remote] & FG
+    remotes = sorted(git_list_remotes(path))
+    if not remotes:
+        return 0, ''
+    retcode = 0
+    output = io.StringIO()
+    with ThreadPoolExecutor(max_workers=len(remotes)) as executor:
+        futures = [executor.submit(git_push_all, path, remote) for remote in remotes]
+        for remote, future in zip(remotes, futures):
+            remote_retcode, remote_output = future.result()
+            retcode = retcode or remote_retcode
+            print(remote if remote_retcode == 0 else f'{remote} (failed with exit code {remote_retcode})', file=output)
+            output.write(remote_output)
+    return retcode, output.getvalue()
 
 def clone_url(repo_name, url):
-    local_path = os.path.join(REPOS_DIR_PATH, repo_name)
-    with local.cwd(REPOS_DIR_PATH):
-        git['clone', url] & FG
+    _git()['-C', REPOS_DIR_PATH, 'clone', url] & FG
 
 def clone_gh(repo_name):
     local_path = os.path.join(REPOS_DIR_PATH, repo_name)
     with local.cwd(REPOS_DIR_PATH):
-        gh['repo', 'clone', repo_name] & FG
+        _gh()['repo', 'clone', repo_name] & FG
 
-def tracking_repo_git_pull():
-    with local.cwd(TRACKING_REPO_PATH):
-        code = git['pull', '--ff-only'] & RETCODE(FG=True)
-        if code != 0:
-            print('A "git pull" of tracking repo was unsuccessful. Perhaps you need to set tracking information on the current branch?', file=sys.stderr)
+def tracking_repo_git_pull(jobs):
+    code = _git()['-C', TRACKING_REPO_PATH, 'pull', '--ff-only', f'--jobs={jobs}'] & RETCODE(FG=True)
+    if code != 0:
+        print('A "git pull" of tracking repo was unsuccessful. Perhaps you need to set tracking information on the current branch?', file=sys.stderr)
 
+@functools.lru_cache(maxsize=128)
 def check_remote_ssh_repo_exists(repo_name, hostname):
-    local_path = os.path.join(REPOS_DIR_PATH, repo_name)
-    with local.cwd(local_path):
-        a = git['fetch', f'{hostname}:{REPOS_DIR_NAME}/{repo_name}', 'main'] & RETCODE
-        b = git['fetch', f'{hostname}:{REPOS_DIR_NAME}/{repo_name}', 'master'] & RETCODE
-        return a == 0 or b == 0
+    # A single ls-remote lists every branch without downloading any objects
+    retcode, stdout, stderr = _git()['ls-remote', '--heads', f'{hostname}:{REPOS_DIR_NAME}/{repo_name}'].run(retcode = None)
+    return retcode == 0 and bool(stdout.strip())
+
+# One gh call answers both whether the repo exists and what its SSH URL is
+@functools.lru_cache(maxsize=128)
+def gh_repo_ssh_url(repo_name):
+    retcode, stdout, stderr = _gh()['repo', 'view', repo_name, '--json', 'sshUrl', '--jq', '.sshUrl'].run(retcode = None)
+    return stdout.strip() if retcode == 0 else None
 
 def check_remote_gh_repo_exists(repo_name):
-    code = gh['repo', 'view', repo_name] & RETCODE
-    return code == 0
+    return gh_repo_ssh_url(repo_name) is not None
 
 def prompt_remote_repo_creation(repo_name, config):
     use_ssh_remotes = None
@@ -123,8 +254,12 @@ def create_remote_repos(repo_name, prompt_result, config):
 
     if prompt_result['use_ssh_remotes']:
         print('Creating repos on remote SSH hosts')
-        for hostname in config['ssh_remotes']:
-            if not check_remote_ssh_repo_exists(repo_name, hostname):
+        hostnames = config['ssh_remotes']
+        # Probe every host at once, but create repos one at a time since that adds remotes to the local repo
+        with ThreadPoolExecutor(max_workers=max(len(hostnames), 1)) as executor:
+            exists = dict(zip(hostnames, executor.map(lambda hostname: check_remote_ssh_repo_exists(repo_name, hostname), hostnames)))
+        for hostname in hostnames:
+            if not exists[hostname]:
                 create_repo_on_ssh_remote(repo_name, hostname)
             else:
                 print(f'Repo {repo_name} already exists on host ${hostname}. Skipping.')
@@ -139,49 +274,52 @@ def create_remote_repos(repo_name, prompt_result, config):
 def reset_remotes(repo_name, config):
     local_path = os.path.join(REPOS_DIR_PATH, repo_name)
     remotes = git_list_remotes(local_path)
-    with local.cwd(local_path):
-        for remote in remotes:
-            git['remote', 'remove', remote]()
+    for remote in remotes:
+        _git()['-C', local_path, 'remote', 'remove', remote]()
+    git_list_remotes.cache_clear()
 
-    add_remotes(repo_name, config)
+    add_remotes(repo_name, config, remotes=frozenset())
 
-def add_remotes(repo_name, config):
+def add_remotes(repo_name, config, remotes=None):
     local_path = os.path.join(REPOS_DIR_PATH, repo_name)
-    remotes = git_list_remotes(local_path)
+    if remotes is None:
+        remotes = git_list_remotes(local_path)
 
     for hostname in config['ssh_remotes']:
         if hostname not in remotes and check_remote_ssh_repo_exists(repo_name, hostname):
-            with local.cwd(local_path):
-                git['remote', 'add', hostname, f'{hostname}:{REPOS_DIR_NAME}/{repo_name}'] & FG
+            _git()['-C', local_path, 'remote', 'add', hostname, f'{hostname}:{REPOS_DIR_NAME}/{repo_name}'] & FG
 
     if config['gh'] and GITHUB_REMOTE_NAME not in remotes and check_remote_gh_repo_exists(repo_name):
-        with local.cwd(local_path):
-            ssh_url = gh['repo', 'view', repo_name, '--json', 'sshUrl', '--jq', '.sshUrl']().strip()
-            git['remote', 'add', GITHUB_REMOTE_NAME, ssh_url] & FG
+        ssh_url = gh_repo_ssh_url(repo_name)
+        _git()['-C', local_path, 'remote', 'add', GITHUB_REMOTE_NAME, ssh_url] & FG
+    git_list_remotes.cache_clear()
 
 def create_repo_on_ssh_remote(repo_name, hostname):
     local_path = os.path.join(REPOS_DIR_PATH, repo_name)
     if not is_git_repo(local_path):
         raise RuntimeError(f'Cannot create remote SSH repo: {local_path} is not a local git repo')
 
-    with SshMachine(hostname) as remote:
-        repo_path = f'{REPOS_DIR_NAME}/{repo_name}.git'
-        remote['mkdir']['-p', REPOS_DIR_NAME]()
-        retcode, _, _ = remote['mkdir'][repo_path].run(retcode = [0, 1])
-        if retcode != 0:
-            print(f'Cannot create repo directory on remote host "{hostname}": repo directory "{repo_name}" already exists', file=sys.stderr)
-            return None
-        with remote.cwd(repo_path):
-            print(f'{hostname}:{str(remote.cwd)}')
-            remote['git']['init', '--bare']()
-            with local.cwd(local_path):
-                git['remote', 'add', hostname, f'{hostname}:{str(remote.cwd)}']()
-                git['push', '--all', hostname]()
+    remote = get_ssh_machine(hostname)
+    repo_path = f'{REPOS_DIR_NAME}/{repo_name}.git'
+    remote['mkdir']['-p', REPOS_DIR_NAME]()
+    retcode, _, _ = remote['mkdir'][repo_path].run(retcode = [0, 1])
+    if retcode != 0:
+        print(f'Cannot create repo directory on remote host "{hostname}": repo directory "{repo_name}" already exists', file=sys.stderr)
+        return None
+    with remote.cwd(repo_path):
+        print(f'{hostname}:{str(remote.cwd)}')
+        remote['git']['init', '--bare']()
+        _git()['-C', local_path, 'remote', 'add', hostname, f'{hostname}:{str(remote.cwd)}']()
+        git_list_remotes.cache_clear()
+        _git()['-C', local_path, 'push', '--all', hostname].with_env(**git_ssh_env(local_path, SSH_OPTS))()
+    check_remote_ssh_repo_exists.cache_clear()
 
 def create_repo_on_github(repo_name, prompt_result):
     local_path = os.path.join(REPOS_DIR_PATH, repo_name)
     if not is_git_repo(local_path):
         raise RuntimeError(f'Cannot create remote GitHub repo: {local_path} is not a local git repo')
     with local.cwd(local_path):
-        gh['repo', 'create', repo_name, f'--{prompt_result["gh_visibility"]}', '--source=.', f'--remote={GITHUB_REMOTE_NAME}']()
-        git['push', '--all', GITHUB_REMOTE_NAME]()
+        _gh()['repo', 'create', repo_name, f'--{prompt_result["gh_visibility"]}', '--source=.', f'--remote={GITHUB_REMOTE_NAME}']()
+    git_list_remotes.cache_clear()
+    gh_repo_ssh_url.cache_clear()
+    _git()['-C', local_path, 'push', '--all', GITHUB_REMOTE_NAME]()
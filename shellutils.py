@@ -1,15 +1,24 @@
 import os
-import plumbum
-from plumbum import FG, BG
-from plumbum import local
+import subprocess
 
 def touch(path):
-    plumbum.cmd.touch(path)
+    with open(path, 'ab'):
+        os.utime(path, None)
+
+def run_combined(command, **kwargs):
+    # Send stderr to the same pipe as stdout so the output keeps the order it was written in
+    proc = command.popen(stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    output, _ = proc.communicate()
+    return proc.returncode, output.decode('utf-8', errors='replace')
 
 def listdir_nohidden(path):
-    for f in os.listdir(path):
-        if not f.startswith('.'):
-            yield f
+    return [f for f in os.listdir(path) if not f.startswith('.')]
+
+def scandir_nohidden(path):
+    with os.scandir(path) as it:
+        for entry in it:
+            if not entry.name.startswith('.'):
+                yield entry
 
 def try_input(prompt):
     try: